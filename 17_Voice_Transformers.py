@@ -30,7 +30,23 @@
     "import numpy as np\n",
     "import scipy.signal as sp\n",
     "import IPython\n",
-    "from scipy.io import wavfile"
+    "from scipy.io import wavfile\n",
+    "import hashlib\n",
+    "from functools import lru_cache\n",
+    "from fractions import Fraction\n",
+    "from numba import njit, prange\n",
+    "try:\n",
+    "    # ahead-of-time compiled LPC kernels, created by running build_aot.py\n",
+    "    import lpc_kernels\n",
+    "except ImportError:\n",
+    "    lpc_kernels = None\n",
+    "try:\n",
+    "    # GPU arrays and FFTs, used for long offline pitch shifting when a GPU is present\n",
+    "    import cupy as cp\n",
+    "    if not cp.cuda.is_available():\n",
+    "        cp = None\n",
+    "except ImportError:\n",
+    "    cp = None"
    ]
   },
   {
@@ -61,7 +77,7 @@
    "outputs": [],
    "source": [
     "Fs, s = wavfile.read('speech.wav')\n",
-    "s = s / 32767.0 # scale the signal to floats in [-1, 1]\n",
+    "s = s / np.float32(32767.0) # scale the signal to single-precision floats in [-1, 1]\n",
     "print('sampling rate: {}Hz'.format(Fs))\n",
     "IPython.display.Audio(s, rate=Fs)"
    ]
@@ -81,6 +97,7 @@
    },
    "outputs": [],
    "source": [
+    "@lru_cache(maxsize=None)\n",
     "def ms2smp(ms, Fs):\n",
     "    return int(float(Fs) * float(ms) / 1000.0)"
    ]
@@ -104,8 +121,9 @@
     "    C = int(len(x) / 2)  # positive frequencies only\n",
     "    if max_freq:\n",
     "        C = int(C * max_freq / float(Fs) * 2) \n",
-    "    X = np.abs(np.fft.fft(x)[0:C]) if do_fft else x[0:C]\n",
-    "    N = Fs * np.arange(0, C) / len(x);\n",
+    "    # the signal is real, so the real-input DFT gives us all the positive frequencies\n",
+    "    X = np.abs(np.fft.rfft(x)[0:C]) if do_fft else x[0:C]\n",
+    "    N = np.fft.rfftfreq(len(x), 1.0 / Fs)[0:C]\n",
     "    plt.plot(N, X)\n",
     "    return N, X"
    ]
@@ -144,9 +162,34 @@
    },
    "outputs": [],
    "source": [
-    "def alien_voice(x, f, Fs):\n",
+    "@njit(cache=True)\n",
+    "def _alien_block(x, y, c, k):\n",
+    "    # the modulating cosine is generated with the recursion\n",
+    "    #   cos(w n) = 2 cos(w) cos(w (n-1)) - cos(w (n-2))\n",
+    "    # where k = 2 cos(w) and c holds the last two oscillator values, so\n",
+    "    # that a signal can be processed block by block\n",
+    "    c1, c2 = c[0], c[1]\n",
+    "    for n in range(0, x.shape[0]):\n",
+    "        c0 = k * c1 - c2\n",
+    "        y[n] = 2 * x[n] * c0\n",
+    "        c2 = c1\n",
+    "        c1 = c0\n",
+    "    c[0], c[1] = c1, c2\n",
+    "\n",
+    "\n",
+    "def alien_voice(x, f, Fs, out=None):\n",
     "    w = (float(f) / Fs) * 2 * np.pi  # normalized modulation frequency\n",
-    "    return 2 * np.multiply(x, np.cos(w * np.arange(0,len(x))))\n",
+    "    x = np.asarray(x, dtype=np.result_type(x, np.float32))\n",
+    "    # the result can be written into a preallocated buffer (even x itself)\n",
+    "    if out is None:\n",
+    "        y = np.empty(len(x), dtype=x.dtype)\n",
+    "    elif out.shape != x.shape or out.dtype.kind != 'f':\n",
+    "        raise ValueError('out must be a floating point array with the same shape as x')\n",
+    "    else:\n",
+    "        y = out\n",
+    "    # oscillator state before the first sample: cos(-w), cos(-2w)\n",
+    "    _alien_block(x, y, np.array([np.cos(w), np.cos(2 * w)]), 2 * np.cos(w))\n",
+    "    return y\n",
     "\n",
     "IPython.display.Audio(alien_voice(s, 500, Fs), rate=Fs)"
    ]
@@ -193,7 +236,7 @@
     "\n",
     "<img width=\"200\" style=\"float: right;\" src=\"turntable.jpg\"> While the alien voice effect can be used as a simple voice obfuscator, we will now consider the problem of changing the pitch of a voice signal to make it sound higher or lower but without the artefacts of sinusoidal modulation.\n",
     " \n",
-    "Let's first introduce a utility function to perform simple fractional resampling, since we will use this function a few times in the rest of the notebook. Given a discrete-time signal $x[n]$ and a real valued time index $N \\le t < N+1$, the function returns the approximate value $x(t)$ as the _linear interpolation_ between $x[N]$ and $x[N+1]$ computed in $t-N$: "
+    "Let's first introduce a utility function to perform simple fractional resampling, since we will use this function a few times in the rest of the notebook. Given a discrete-time signal $x[n]$ and a real valued time index $N \\le t < N+1$, the function returns the approximate value $x(t)$ as the _linear interpolation_ between $x[N]$ and $x[N+1]$ computed in $t-N$: since we will need many interpolated values at a time, the function accepts an array of time indices as well, so that the interpolation is computed by NumPy in a single pass rather than one sample at a time in Python:"
    ]
   },
   {
@@ -205,15 +248,10 @@
    "outputs": [],
    "source": [
     "def subsample(x, t):\n",
-    "    n = int(t)\n",
-    "    a = 1.0 - (t - n)\n",
-    "    try:\n",
-    "        return a * x[n] + (1 - a) * x[n + 1] \n",
-    "    except IndexError:\n",
-    "        try:\n",
-    "            return a * x[n]\n",
-    "        except IndexError:\n",
-    "            return 0"
+    "    # t can be a single time index or an array of time indices; samples\n",
+    "    # outside of x are considered to be zero, so we append a zero to x\n",
+    "    # before interpolating and return zero to the right of it\n",
+    "    return np.interp(t, np.arange(0, len(x) + 1), np.r_[x, 0], right=0)"
    ]
   },
   {
@@ -234,10 +272,9 @@
     "def resample(x, f):\n",
     "    # length of the output signal after resampling\n",
     "    n_out = int(np.floor(len(x) / f))\n",
-    "    y = np.zeros(n_out)\n",
-    "    for n in range(0, n_out):\n",
-    "        y[n] = subsample(x, float(n) * f)\n",
-    "    return y"
+    "    # all the output samples are interpolated at once\n",
+    "    # (np.interp works in double precision, so convert back to the input precision)\n",
+    "    return subsample(x, np.arange(0, n_out) * float(f)).astype(np.result_type(x, np.float32))"
    ]
   },
   {
@@ -278,6 +315,40 @@
     "IPython.display.Audio(resample(s, 2), rate=Fs)"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "Linear interpolation is cheap, but it introduces audible aliasing, especially when the pitch is raised. If quality matters more than simplicity, we can approximate the resampling factor with a ratio of small integers and use a polyphase lowpass filter instead, as implemented by `resample_poly` in SciPy; the filtering runs entirely in compiled code, so the function is fast as well:"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "def resample_hq(x, f):\n",
+    "    # resampling factor as a ratio of integers: f = down / up\n",
+    "    r = Fraction(f).limit_denominator(1000)\n",
+    "    y = sp.resample_poly(x, r.denominator, r.numerator, window=('kaiser', 8.6))\n",
+    "    # same output length as resample\n",
+    "    return y[0:int(np.floor(len(x) / f))]"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "IPython.display.Audio(resample_hq(s, 2), rate=Fs)"
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -313,10 +384,13 @@
    "source": [
     "def double_len(x, G):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(2 * N)\n",
-    "    for n in range(0, len(x) - G, G):\n",
-    "        y[2*n:2*n+G] = x[n:n+G]\n",
-    "        y[2*n+G:2*n+2*G] = x[n:n+G]\n",
+    "    # integer samples are returned as floating point, like in the other functions\n",
+    "    y = np.zeros(2 * N, dtype=np.result_type(x, np.float32))\n",
+    "    # number of full grains (as in range(0, N - G, G)), one per row\n",
+    "    K = len(range(0, N - G, G))\n",
+    "    grains = x[0:K*G].reshape(K, G)\n",
+    "    # each grain is written twice, back to back\n",
+    "    y[0:2*K*G] = np.repeat(grains, 2, axis=0).ravel()\n",
     "    return y"
    ]
   },
@@ -356,7 +430,7 @@
    "cell_type": "markdown",
    "metadata": {},
    "source": [
-    "To mitigate this click noise we need to *crossfade* the grains. To do so, we employ a *tapered* window that smooths to zero the beginning and end of each grain. The following function returns a simple window shaped as an isosceles trapezoid. The parameter $0 \\le a \\le 1$ determines the *total* amount of taper. The function also returns a stride value which can be used to shift the analysis window so that the tapered parts align exactly: "
+    "To mitigate this click noise we need to *crossfade* the grains. To do so, we employ a *tapered* window that smooths to zero the beginning and end of each grain. The following function returns a simple window shaped as an isosceles trapezoid. The parameter $0 \\le a \\le 1$ determines the *total* amount of taper. The function also returns a stride value which can be used to shift the analysis window so that the tapered parts align exactly. Since the pitch shifters below request the same few windows over and over, the function caches its results; the returned window is read-only and must be copied before modifying it:"
    ]
   },
   {
@@ -367,11 +441,14 @@
    },
    "outputs": [],
    "source": [
+    "@lru_cache(maxsize=32)\n",
     "def win_taper(N, a):\n",
     "    R = int(N * a / 2)\n",
     "    r = np.arange(0, R) / float(R)\n",
     "    win = np.r_[r, np.ones(N - 2*R), r[::-1]]\n",
     "    stride = N - R - 1\n",
+    "    # the same window is returned to all callers, so make sure nobody modifies it\n",
+    "    win.flags.writeable = False\n",
     "    return win, stride"
    ]
   },
@@ -412,14 +489,14 @@
    "source": [
     "def double_len2(x, G):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(2 * N)\n",
+    "    y = np.zeros(2 * N, dtype=np.result_type(x, np.float32))\n",
     "    overlap = 0.4\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    ix = 0\n",
-    "    for n in range(0, len(x) - G, G):\n",
-    "        for k in [0, 1]:\n",
-    "            y[ix:ix+G] += x[n:n+G] * win\n",
-    "            ix += stride\n",
+    "    K = len(range(0, N - G, G))\n",
+    "    grains = x[0:K*G].reshape(K, G) * win\n",
+    "    # each windowed grain is added twice, at consecutive multiples of the stride\n",
+    "    ix = (np.arange(0, 2 * K) * stride)[:, np.newaxis] + np.arange(0, G)\n",
+    "    np.add.at(y, ix, np.repeat(grains, 2, axis=0))\n",
     "    return y"
    ]
   },
@@ -552,15 +629,36 @@
    },
    "outputs": [],
    "source": [
+    "def grain_interp(f, G, igs):\n",
+    "    # indices and weights of the linear interpolation that resamples a grain of\n",
+    "    # igs samples into G samples; as in subsample, samples past the end of the\n",
+    "    # grain are zero, so we clamp the indices and set their weights to zero\n",
+    "    # instead of padding the grain\n",
+    "    t = np.arange(0, G) * float(f)\n",
+    "    n = t.astype(int)\n",
+    "    a = 1.0 - (t - n)\n",
+    "    a0 = np.where(n < igs, a, 0)\n",
+    "    a1 = np.where(n + 1 < igs, 1 - a, 0)\n",
+    "    return np.minimum(n, igs - 1), np.minimum(n + 1, igs - 1), a0, a1\n",
+    "\n",
+    "\n",
     "def GS_pshift(x, f, G, overlap=0.5):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(N)\n",
+    "    dtype = np.result_type(x, np.float32)\n",
+    "    y = np.zeros(N, dtype=dtype)\n",
     "    # size of input buffer given grain size and resampling factor\n",
     "    igs = int(G * f + 0.5)\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    for n in range(0, len(x) - max(igs, G), stride):\n",
-    "        w = resample(x[n:n+igs], f)\n",
-    "        y[n:n+G] += w * win\n",
+    "    # start index of each grain\n",
+    "    starts = np.arange(0, len(x) - max(igs, G), stride)[:, np.newaxis]\n",
+    "    # the interpolation indices and weights are the same for all grains, so\n",
+    "    # we can resample all grains at once\n",
+    "    n0, n1, a0, a1 = grain_interp(f, G, igs)\n",
+    "    # (integer samples are interpolated in floating point)\n",
+    "    a0, a1 = a0.astype(dtype), a1.astype(dtype)\n",
+    "    w = a0 * x[starts + n0].astype(dtype, copy=False) + a1 * x[starts + n1].astype(dtype, copy=False)\n",
+    "    # overlap-add the windowed grains\n",
+    "    np.add.at(y, starts + np.arange(0, G), w * win)\n",
     "    return y"
    ]
   },
@@ -623,6 +721,68 @@
     "IPython.display.Audio(GS_pshift(s, 0.6, ms2smp(31, Fs), .5), rate=Fs) "
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "The granular pitch shifter is the workhorse of a real-time voice changer, so it is worth making it as fast as possible. Since all grains use the same interpolation pattern, we can compile the whole algorithm with [Numba](https://numba.pydata.org/) and compute each output sample directly as the sum of the (at most three) overlapping windowed grains that contain it. In this formulation the output samples are independent of each other and can be computed in parallel on all available cores, without the race conditions that would arise if different threads were to overlap-add whole grains into the same output buffer:"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "@njit(parallel=True, fastmath=True, cache=True)\n",
+    "def _gs_pshift_core(x, f, igs, win, stride, K):\n",
+    "    G = win.shape[0]\n",
+    "    y = np.zeros(x.shape[0], dtype=x.dtype)\n",
+    "    for m in prange(0, min((K - 1) * stride + G, x.shape[0])):\n",
+    "        # grains k such that k * stride <= m < k * stride + G\n",
+    "        k = max(0, (m - G) // stride + 1)\n",
+    "        acc = 0.0\n",
+    "        while k < K and k * stride <= m:\n",
+    "            n = k * stride\n",
+    "            j = m - n\n",
+    "            t = j * f\n",
+    "            i = min(int(t), igs)\n",
+    "            a = 1.0 - (t - i)\n",
+    "            # as in subsample, samples past the end of the input grain are zero\n",
+    "            v = a * x[n + i] if i < igs else 0.0\n",
+    "            if i + 1 < igs:\n",
+    "                v += (1 - a) * x[n + i + 1]\n",
+    "            acc += v * win[j]\n",
+    "            k += 1\n",
+    "        y[m] = acc\n",
+    "    return y\n",
+    "\n",
+    "\n",
+    "def GS_pshift_nb(x, f, G, overlap=0.5):\n",
+    "    igs = int(G * f + 0.5)\n",
+    "    win, stride = win_taper(G, overlap)\n",
+    "    # number of grains, as in GS_pshift\n",
+    "    K = len(range(0, len(x) - max(igs, G), stride))\n",
+    "    # the output has the precision of x, or single precision for integer samples\n",
+    "    x = np.ascontiguousarray(x, dtype=np.result_type(x, np.float32))\n",
+    "    if K == 0:\n",
+    "        return np.zeros(len(x), dtype=x.dtype)\n",
+    "    return _gs_pshift_core(x, float(f), igs, win, stride, K)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "IPython.display.Audio(GS_pshift_nb(s, 0.6, ms2smp(31, Fs), .5), rate=Fs) "
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -652,6 +812,7 @@
    "outputs": [],
    "source": [
     "Fs_y, y = wavfile.read('clarinet.wav')\n",
+    "y = y / np.float32(32767.0) # cast to single-precision floats in [-1, 1]\n",
     "IPython.display.Audio(y, rate=Fs_y)"
    ]
   },
@@ -685,10 +846,10 @@
    "source": [
     "def DFT_translate(x, k):\n",
     "    N = len(x)        \n",
-    "    X = np.fft.fft(x - np.mean(x))\n",
-    "    Y = np.r_[np.zeros(k), X[0:int(N/2-k)]]\n",
-    "    y = np.fft.ifft(np.r_[Y, np.conj(Y[-1:0:-1])])\n",
-    "    return np.real(y[0:N])\n",
+    "    X = np.fft.rfft(x - np.mean(x))\n",
+    "    Y = np.r_[np.zeros(k, dtype=X.dtype), X[0:int(N/2-k)]]\n",
+    "    y = np.fft.irfft(Y, 2 * len(Y) - 1)\n",
+    "    return y[0:N]\n",
     "\n",
     "IPython.display.Audio(DFT_translate(y, 210), rate=Fs_y)"
    ]
@@ -710,21 +871,27 @@
    },
    "outputs": [],
    "source": [
+    "@lru_cache(maxsize=32)\n",
+    "def _rescale_map(N, f):\n",
+    "    # source and destination bins of the frequency rescaling; the map only\n",
+    "    # depends on the DFT size and on the factor, so we compute it only once\n",
+    "    ix = (np.arange(0, N) * f).astype(int)\n",
+    "    src = np.flatnonzero(ix < N)\n",
+    "    dst = ix[src]\n",
+    "    src.flags.writeable = dst.flags.writeable = False\n",
+    "    return src, dst\n",
+    "\n",
+    "\n",
     "def DFT_rescale(x, f):\n",
-    "    X = np.fft.fft(x)\n",
-    "    # separate even and odd lengths\n",
-    "    parity = (len(X) % 2 == 0)\n",
-    "    N = int(len(X) / 2) + 1 if parity else (len(X) + 1) / 2\n",
-    "    Y = np.zeros(N, dtype=np.complex)\n",
-    "    # work only in the first half of the DFT vector since input is real\n",
-    "    for n in range(0, N):\n",
-    "        # accumulate original frequency bins into rescaled bins\n",
-    "        ix = int(n * f)\n",
-    "        if ix < N:\n",
-    "            Y[ix] += X[n]\n",
-    "    # now rebuild a Hermitian-symmetric DFT\n",
-    "    Y = np.r_[Y, np.conj(Y[-2:0:-1])] if parity else np.r_[Y, np.conj(Y[-1:0:-1])]\n",
-    "    return np.real(np.fft.ifft(Y))"
+    "    # the input is real so we only need the first half of the DFT vector;\n",
+    "    # if x is a 2-D array, each row is rescaled independently\n",
+    "    X = np.fft.rfft(x)\n",
+    "    Y = np.zeros(X.shape, dtype=X.dtype)\n",
+    "    # accumulate original frequency bins into rescaled bins\n",
+    "    src, dst = _rescale_map(X.shape[-1], float(f))\n",
+    "    np.add.at(Y.T, dst, X[..., src].T)\n",
+    "    # the inverse real DFT implicitly rebuilds the Hermitian-symmetric DFT\n",
+    "    return np.fft.irfft(Y, x.shape[-1])"
    ]
   },
   {
@@ -764,13 +931,26 @@
    },
    "outputs": [],
    "source": [
+    "@njit(cache=True)\n",
+    "def _overlap_add(y, frames, win, stride):\n",
+    "    # windows each frame and accumulates it into y at multiples of the\n",
+    "    # stride, without creating any intermediate arrays\n",
+    "    K, G = frames.shape\n",
+    "    for k in range(0, K):\n",
+    "        n = k * stride\n",
+    "        for j in range(0, G):\n",
+    "            y[n + j] += frames[k, j] * win[j]\n",
+    "\n",
+    "\n",
     "def DFT_pshift(x, f, G, overlap=0):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(N)\n",
+    "    dtype = np.result_type(x, np.float32)\n",
+    "    y = np.zeros(N, dtype=dtype)\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    for n in range(0, len(x) - G, stride):\n",
-    "        w = DFT_rescale(x[n:n+G] * win, f)\n",
-    "        y[n:n+G] += w * win\n",
+    "    # the windowed segments are the rows of a matrix that we can rescale in one go\n",
+    "    frames = x[np.arange(0, len(x) - G, stride)[:, np.newaxis] + np.arange(0, G)].astype(dtype, copy=False)\n",
+    "    frames *= win\n",
+    "    _overlap_add(y, DFT_rescale(frames, f), win, stride)\n",
     "    return y"
    ]
   },
@@ -810,6 +990,54 @@
     "IPython.display.Audio(DFT_pshift(s, 1.5, ms2smp(40, Fs), 0.4), rate=Fs)"
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "When the goal is not real-time processing but, say, shifting the pitch of a large collection of recordings offline, all the frames of an utterance can be processed at once on a GPU, if one is available. The bin rescaling is expressed as a product with a 0-1 matrix (which maps each source bin to its destination bin) so that it can run as a single matrix multiplication, and the overlap-add is split into groups of frames that do not overlap with each other:"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "def DFT_pshift_gpu(x, f, G, overlap=0):\n",
+    "    # without a GPU, use the CPU version\n",
+    "    if cp is None:\n",
+    "        return DFT_pshift(x, f, G, overlap)\n",
+    "    win, stride = win_taper(G, overlap)\n",
+    "    xg = cp.asarray(x)\n",
+    "    wg = cp.asarray(win, dtype=xg.dtype)\n",
+    "    ix = cp.arange(0, len(x) - G, stride)[:, np.newaxis] + cp.arange(0, G)\n",
+    "    X = cp.fft.rfft(xg[ix] * wg)\n",
+    "    # rescaling matrix: row src[i] has a one in column dst[i]\n",
+    "    src, dst = _rescale_map(X.shape[-1], float(f))\n",
+    "    M = np.zeros((X.shape[-1], X.shape[-1]), dtype=X.dtype)\n",
+    "    M[src, dst] = 1\n",
+    "    w = cp.fft.irfft(X @ cp.asarray(M), G) * wg\n",
+    "    # frames that are at least G samples apart can be added without conflicts\n",
+    "    y = cp.zeros(len(x), dtype=xg.dtype)\n",
+    "    P = -(-G // stride)\n",
+    "    for k in range(0, P):\n",
+    "        y[ix[k::P]] += w[k::P]\n",
+    "    return cp.asnumpy(y)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "IPython.display.Audio(DFT_pshift_gpu(s, 1.5, ms2smp(40, Fs), 0.4), rate=Fs)"
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -817,6 +1045,112 @@
     "This pitch-shifting technique can be implemented in real time, with a processing delay equal to the size of the analysis window. Also, more advanced versions (such as commercial \"auto-tune\" applications) take great care to minimize the artifacts that you can still hear in this very simple version using way more sophisticated frame analysis. We won't pursue this approach here because, in all of the methods we have seen so far, we have neglected one fundamental aspect of voice manipulation, namely, preserving the position of the formants. This can only be achieved by doing a more sophisticated analysis of each speech segment. "
    ]
   },
+  {
+   "cell_type": "markdown",
+   "metadata": {},
+   "source": [
+    "To see what this means in practice, here is a streaming version of the granular and DFT-based pitch shifters. In a real-time application the audio interface delivers the input in small blocks (typically a few milliseconds of audio) and expects an output block of the same size in return; the object below keeps the input samples and the partially overlap-added output between calls in two ring buffers, whose size is fixed by the grain size and the block size, so that no memory is allocated for them while streaming. A grain is processed as soon as all of its input samples are available and each output sample is returned once all the grains that overlap it have been added in, so the output is simply the output of the offline function delayed by a fixed latency:"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "def _ring_slices(ring, n, L):\n",
+    "    # the two slices of a ring buffer holding the L samples that start at the\n",
+    "    # absolute position n (the second one is empty if there is no wraparound)\n",
+    "    i = n % len(ring)\n",
+    "    k = min(L, len(ring) - i)\n",
+    "    return slice(i, i + k), slice(0, L - k), k\n",
+    "\n",
+    "\n",
+    "class GrainProcessor:\n",
+    "    # processes a signal grain by grain, one block of at most B samples at a time;\n",
+    "    # the function grain maps the input samples of a grain to its G output samples\n",
+    "    def __init__(self, G, igs, overlap, grain, B):\n",
+    "        self.G = G\n",
+    "        self.B = B\n",
+    "        self.grain = grain\n",
+    "        self.win, self.stride = win_taper(G, overlap)\n",
+    "        # number of input samples needed to process a grain\n",
+    "        self.size = max(igs, G)\n",
+    "        # the output is delayed by this many samples\n",
+    "        self.latency = self.size - 1\n",
+    "        # input ring: fewer than size samples are left over from the previous block\n",
+    "        self.inbuf = np.zeros(self.size - 1 + B)\n",
+    "        # output ring, holding the overlap-add accumulator already delayed by the latency\n",
+    "        self.outbuf = np.zeros(G + B)\n",
+    "        # contiguous copy of the current grain\n",
+    "        self.frame = np.zeros(self.size)\n",
+    "        # absolute positions of the next input sample, of the beginning of the next\n",
+    "        # grain and of the next output sample\n",
+    "        self.n_in = self.n_grain = self.n_out = 0\n",
+    "\n",
+    "    def process(self, block):\n",
+    "        B = len(block)\n",
+    "        if B > self.B:\n",
+    "            raise ValueError('blocks can be at most {} samples long'.format(self.B))\n",
+    "        s1, s2, k = _ring_slices(self.inbuf, self.n_in, B)\n",
+    "        self.inbuf[s1], self.inbuf[s2] = block[0:k], block[k:]\n",
+    "        self.n_in += B\n",
+    "        while self.n_grain + self.size <= self.n_in:\n",
+    "            s1, s2, k = _ring_slices(self.inbuf, self.n_grain, self.size)\n",
+    "            self.frame[0:k], self.frame[k:] = self.inbuf[s1], self.inbuf[s2]\n",
+    "            w = self.grain(self.frame) * self.win\n",
+    "            s1, s2, k = _ring_slices(self.outbuf, self.n_grain + self.latency, self.G)\n",
+    "            self.outbuf[s1] += w[0:k]\n",
+    "            self.outbuf[s2] += w[k:]\n",
+    "            self.n_grain += self.stride\n",
+    "        # all the grains overlapping the output samples up to n_in have been added in\n",
+    "        s1, s2, k = _ring_slices(self.outbuf, self.n_out, B)\n",
+    "        y = np.empty(B)\n",
+    "        y[0:k], y[k:] = self.outbuf[s1], self.outbuf[s2]\n",
+    "        # clear the returned samples for the grains still to come\n",
+    "        self.outbuf[s1], self.outbuf[s2] = 0, 0\n",
+    "        self.n_out += B\n",
+    "        return y\n",
+    "\n",
+    "\n",
+    "class GSPitchShifter(GrainProcessor):\n",
+    "    def __init__(self, f, G, B, overlap=0.5):\n",
+    "        self.igs = int(G * f + 0.5)\n",
+    "        super().__init__(G, self.igs, overlap, self._resample, B)\n",
+    "        # same interpolation as in GS_pshift\n",
+    "        self.n0, self.n1, self.a0, self.a1 = grain_interp(f, G, self.igs)\n",
+    "\n",
+    "    def _resample(self, x):\n",
+    "        return self.a0 * x[self.n0] + self.a1 * x[self.n1]\n",
+    "\n",
+    "\n",
+    "class DFTPitchShifter(GrainProcessor):\n",
+    "    def __init__(self, f, G, B, overlap=0):\n",
+    "        super().__init__(G, G, overlap, self._rescale, B)\n",
+    "        self.f = f\n",
+    "\n",
+    "    def _rescale(self, x):\n",
+    "        return DFT_rescale(x * self.win, self.f)"
+   ]
+  },
+  {
+   "cell_type": "code",
+   "execution_count": null,
+   "metadata": {
+    "collapsed": true
+   },
+   "outputs": [],
+   "source": [
+    "# simulate an audio interface delivering blocks of 10ms\n",
+    "B = ms2smp(10, Fs)\n",
+    "shifter = GSPitchShifter(0.6, ms2smp(31, Fs), B, .5)\n",
+    "y = np.concatenate([shifter.process(s[n:n+B]) for n in range(0, len(s), B)])\n",
+    "print('latency: {:.1f}ms'.format(1000.0 * shifter.latency / Fs))\n",
+    "IPython.display.Audio(y, rate=Fs)"
+   ]
+  },
   {
    "cell_type": "markdown",
    "metadata": {},
@@ -837,7 +1171,7 @@
    "outputs": [],
    "source": [
     "Fs_y, y = wavfile.read('voiced.wav')\n",
-    "y = y / 32767.0 # cast to floats in [-1, 1]\n",
+    "y = y / np.float32(32767.0) # cast to single-precision floats in [-1, 1]\n",
     "plot_spec(y, Fs_y)\n",
     "Y = np.fft.fft([1.0, -2.1793, 2.4140, -1.6790, 0.3626, 0.5618, -0.7047, \n",
     "                0.1956, 0.1872, -0.2878, 0.2354, -0.0577, -0.0815, 0.0946, \n",
@@ -904,6 +1238,8 @@
     "    r_m = (1/N)\\sum_{k = 0}^{N-m-1}x[k]x[k+m]\n",
     "$$\n",
     "\n",
+    "Since we only need the first $p+1$ lags of the autocorrelation, we compute them with a compiled direct sum for the low orders used with speech, and via the DFT of the zero-padded segment for higher orders; a library call such as `np.correlate(x, x, 'full')` would be simpler to write but it computes all $2N-1$ lags and is slower in both regimes.\n",
+    "\n",
     "Because of the Toeplitz structure of the autocorrelation matrix, the system of equations can be solved very efficiently using the Levinson-Durbin algorithm. Here is a direct implementation of the method:"
    ]
   },
@@ -915,15 +1251,41 @@
    },
    "outputs": [],
    "source": [
+    "@njit(cache=True, fastmath=True)\n",
+    "def _bac_direct(x, p, alpha=0.0):\n",
+    "    L = x.shape[0]\n",
+    "    r = np.zeros(p + 1)\n",
+    "    for m in range(0, p + 1):\n",
+    "        acc = 0.0\n",
+    "        if alpha == 0:\n",
+    "            for n in range(0, L - m):\n",
+    "                # accumulate in double precision even for single-precision input;\n",
+    "                # with fastmath the compiler already splits this sum across SIMD\n",
+    "                # lanes, which is faster than doing it by hand\n",
+    "                acc += np.float64(x[n]) * x[n + m]\n",
+    "        elif m < L:\n",
+    "            # autocorrelation of the pre-emphasized segment x[n] - alpha x[n-1],\n",
+    "            # computed on the fly from the original samples\n",
+    "            acc = np.float64(x[0]) * (x[m] - alpha * x[m-1] if m > 0 else x[0])\n",
+    "            for n in range(1, L - m):\n",
+    "                acc += (np.float64(x[n]) - alpha * x[n-1]) * (x[n+m] - alpha * x[n+m-1])\n",
+    "        r[m] = acc / L\n",
+    "    return r\n",
+    "\n",
+    "\n",
     "def bac(x, p):\n",
     "    # compute the biased autocorrelation for x up to lag p\n",
     "    L = len(x)\n",
-    "    r = np.zeros(p+1)\n",
-    "    for m in range(0, p+1):\n",
-    "        for n in range(0, L-m):\n",
-    "            r[m] += x[n] * x[n+m]\n",
-    "        r[m] /= float(L)\n",
-    "    return r"
+    "    # for the low model orders used with speech, a compiled direct sum is\n",
+    "    # faster than going through the DFT\n",
+    "    if p <= 64:\n",
+    "        return _bac_direct(np.asarray(x), p)\n",
+    "    # otherwise, the autocorrelation is the inverse DFT of the power spectrum;\n",
+    "    # zero-padding to at least L + p points ensures that lags 0 to p are not\n",
+    "    # affected by circular aliasing\n",
+    "    nfft = 1 << int(np.ceil(np.log2(L + p)))\n",
+    "    X = np.fft.rfft(np.asarray(x, dtype=float), nfft)\n",
+    "    return np.fft.irfft(X.real ** 2 + X.imag ** 2, nfft)[0:p+1] / float(L)"
    ]
   },
   {
@@ -935,16 +1297,18 @@
    "outputs": [],
    "source": [
     "def ld(r, p):\n",
-    "    # solve the toeplitz system using the Levinson-Durbin algorithm\n",
-    "    g = r[1] / r[0]\n",
-    "    a = np.array([g])\n",
-    "    v = (1. - g * g) * r[0];\n",
+    "    # solve the toeplitz system using the Levinson-Durbin algorithm;\n",
+    "    # a[0:i] holds the coefficients of the order-i predictor\n",
+    "    a = np.zeros(p)\n",
+    "    a[0] = r[1] / r[0]\n",
+    "    v = (1. - a[0] * a[0]) * r[0];\n",
     "    for i in range(1, p):\n",
-    "        g = (r[i+1] - np.dot(a, r[1:i+1])) / v\n",
-    "        a = np.r_[ g,  a - g * a[i-1::-1] ]\n",
+    "        g = (r[i+1] - np.dot(a[0:i], r[i:0:-1])) / v\n",
+    "        a[0:i] -= g * a[i-1::-1]\n",
+    "        a[i] = g\n",
     "        v *= 1. - g*g\n",
     "    # return the coefficients of the A(z) filter\n",
-    "    return np.r_[1, -a[::-1]]     "
+    "    return np.r_[1, -a]     "
    ]
   },
   {
@@ -955,9 +1319,143 @@
    },
    "outputs": [],
    "source": [
-    "def lpc(x, p):\n",
-    "    # compute p LPC coefficients for a speech segment\n",
-    "    return ld(bac(x, p), p)"
+    "@njit(cache=True, fastmath={'contract'})\n",
+    "def _ld_nb(r, p):\n",
+    "    # same algorithm as ld, compiled and working in place: c holds the\n",
+    "    # prediction coefficients a_1, ..., a_i at step i. Since the right-hand\n",
+    "    # side of the LPC equations is itself part of the Toeplitz matrix, this is\n",
+    "    # Durbin's specialization of the Levinson recursion (Golub & Van Loan,\n",
+    "    # Alg. 4.7.1), which needs about 2p^2 operations and no extra vectors.\n",
+    "    # Only floating-point contraction is enabled, so that the multiply-adds\n",
+    "    # below become FMA instructions without reordering the sums. No checks on\n",
+    "    # g are needed: the biased autocorrelation is positive definite, so the\n",
+    "    # reflection coefficients satisfy |g| < 1 and v stays positive\n",
+    "    c = np.zeros(p)\n",
+    "    c[0] = r[1] / r[0]\n",
+    "    v = (1. - c[0] * c[0]) * r[0]\n",
+    "    for i in range(1, p):\n",
+    "        acc = 0.0\n",
+    "        for k in range(0, i):\n",
+    "            acc += c[k] * r[i-k]\n",
+    "        g = (r[i+1] - acc) / v\n",
+    "        # symmetric update of the previous coefficients\n",
+    "        for k in range(0, (i + 1) // 2):\n",
+    "            lo, hi = c[k], c[i-1-k]\n",
+    "            c[k] = lo - g * hi\n",
+    "            c[i-1-k] = hi - g * lo\n",
+    "        c[i] = g\n",
+    "        v *= 1. - g * g\n",
+    "    # return the coefficients of the A(z) filter\n",
+    "    a = np.empty(p + 1)\n",
+    "    a[0] = 1.\n",
+    "    a[1:] = -c\n",
+    "    return a\n",
+    "\n",
+    "\n",
+    "@njit(cache=True)\n",
+    "def _lpc_nb(x, p, alpha):\n",
+    "    # pre-emphasis, autocorrelation and Levinson-Durbin in a single compiled call\n",
+    "    return _ld_nb(_bac_direct(x, p, alpha), p)\n",
+    "\n",
+    "\n",
+    "def lpc(x, p, alpha=0.0):\n",
+    "    # compute p LPC coefficients for a speech segment; optionally, the segment\n",
+    "    # is first pre-emphasized with the filter 1 - alpha z^{-1} (alpha is usually\n",
+    "    # around 0.95) to flatten the spectral tilt of voiced speech\n",
+    "    if p <= 64:\n",
+    "        # same threshold as in bac\n",
+    "        if lpc_kernels is not None and alpha == 0:\n",
+    "            return lpc_kernels.lpc(np.ascontiguousarray(x, dtype=float), p)\n",
+    "        return _lpc_nb(np.asarray(x), p, float(alpha))\n",
+    "    if alpha:\n",
+    "        x = sp.lfilter([1, -alpha], [1], x)\n",
+    "    return _ld_nb(bac(x, p), p)\n",
+    "\n",
+    "\n",
+    "@njit(parallel=True, cache=True)\n",
+    "def _batch_lpc_nb(segments, p, alpha):\n",
+    "    A = np.empty((segments.shape[0], p + 1))\n",
+    "    for i in prange(0, segments.shape[0]):\n",
+    "        A[i] = _lpc_nb(segments[i], p, alpha)\n",
+    "    return A\n",
+    "\n",
+    "\n",
+    "def batch_lpc(segments, p, alpha=0.0):\n",
+    "    # LPC coefficients for each row of a matrix of speech segments; the\n",
+    "    # segments are independent, so they are analyzed in parallel\n",
+    "    return _batch_lpc_nb(np.asarray(segments), p, float(alpha))\n",
+    "\n",
+    "\n",
+    "@njit(cache=True, fastmath=True)\n",
+    "def lpc_error(a, x):\n",
+    "    # prediction error (i.e. the excitation) for x, same as sp.lfilter(a, [1], x)\n",
+    "    e = np.empty(x.shape[0], dtype=x.dtype)\n",
+    "    for n in range(0, x.shape[0]):\n",
+    "        acc = 0.0\n",
+    "        for k in range(0, min(n + 1, a.shape[0])):\n",
+    "            acc += a[k] * x[n-k]\n",
+    "        e[n] = acc\n",
+    "    return e\n",
+    "\n",
+    "\n",
+    "@njit(cache=True, fastmath=True)\n",
+    "def lpc_synth(a, e):\n",
+    "    # all-pole synthesis filter 1/A(z), same as sp.lfilter([1], a, e)\n",
+    "    y = np.empty(e.shape[0], dtype=e.dtype)\n",
+    "    for n in range(0, e.shape[0]):\n",
+    "        acc = e[n]\n",
+    "        for k in range(1, min(n + 1, a.shape[0])):\n",
+    "            acc -= a[k] * y[n-k]\n",
+    "        y[n] = acc\n",
+    "    return y\n",
+    "\n",
+    "\n",
+    "@njit(parallel=True, cache=True)\n",
+    "def _batch_lpc_error(A, segments):\n",
+    "    E = np.empty_like(segments)\n",
+    "    for i in prange(0, segments.shape[0]):\n",
+    "        E[i] = lpc_error(A[i], segments[i])\n",
+    "    return E\n",
+    "\n",
+    "\n",
+    "@njit(parallel=True, cache=True)\n",
+    "def _batch_lpc_synth(A, E):\n",
+    "    W = np.empty_like(E)\n",
+    "    for i in prange(0, E.shape[0]):\n",
+    "        W[i] = lpc_synth(A[i], E[i])\n",
+    "    return W\n",
+    "\n",
+    "\n",
+    "_lpc_cache = {}\n",
+    "\n",
+    "def lpc_analysis(x, L, P, stride, M=None, alpha=0.0):\n",
+    "    # LPC analysis of the segments x[n:n+L] for n in range(0, len(x) - M, stride):\n",
+    "    # returns the start indices, the LPC coefficients and the excitation of each\n",
+    "    # segment. With alpha > 0 the coefficients are estimated on the pre-emphasized\n",
+    "    # segments, while the excitation is still computed from the original ones so\n",
+    "    # that the synthesis filter recovers them exactly. The analysis does not\n",
+    "    # depend on how the excitation is modified afterwards, so the result is\n",
+    "    # cached and reused by repeated calls on the same signal. Integer samples are\n",
+    "    # analyzed in single precision, so that the excitation is not truncated\n",
+    "    x = np.ascontiguousarray(x, dtype=np.result_type(x, np.float32))\n",
+    "    M = L if M is None else M\n",
+    "    key = (hashlib.sha1(x).hexdigest(), x.dtype.str, L, P, stride, M, alpha)\n",
+    "    if key not in _lpc_cache:\n",
+    "        if len(_lpc_cache) >= 16:\n",
+    "            _lpc_cache.clear()\n",
+    "        starts = np.arange(0, len(x) - M, stride)\n",
+    "        # all the analysis segments, one per row\n",
+    "        segments = x[starts[:, np.newaxis] + np.arange(0, L)]\n",
+    "        A = batch_lpc(segments, P, alpha)\n",
+    "        # the inverse filter starts from rest for each segment, just like the\n",
+    "        # synthesis filter lpc_synth, so that the two cancel exactly when the\n",
+    "        # excitation is not modified; carrying the filter state over from the\n",
+    "        # previous samples would introduce a transient in the resynthesis\n",
+    "        E = _batch_lpc_error(A, segments)\n",
+    "        for v in (starts, A, E):\n",
+    "            v.flags.writeable = False\n",
+    "        _lpc_cache[key] = (starts, A, E)\n",
+    "    return _lpc_cache[key]"
    ]
   },
   {
@@ -1004,17 +1502,14 @@
    },
    "outputs": [],
    "source": [
-    "def LPC_DFT_pshift(x, f, G, P, th, overlap):\n",
+    "def LPC_DFT_pshift(x, f, G, P, th, overlap, alpha=0.0):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(N)\n",
+    "    y = np.zeros(N, dtype=np.result_type(x, np.float32))\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    for n in range(0, len(x) - G, stride):\n",
-    "        w = x[n:n+G]\n",
-    "        a = lpc(w, P)\n",
-    "        e = sp.lfilter(a, [1], w)\n",
-    "        e = DFT_rescale(e, f)\n",
-    "        w = sp.lfilter([1], a, e)\n",
-    "        y[n:n+G] += w * win\n",
+    "    _, A, E = lpc_analysis(x, G, P, stride, alpha=alpha)\n",
+    "    # the excitations of all segments are rescaled with one batched DFT\n",
+    "    W = _batch_lpc_synth(A, DFT_rescale(E, f))\n",
+    "    _overlap_add(y, W, win, stride)\n",
     "    return y    "
    ]
   },
@@ -1055,17 +1550,15 @@
    },
    "outputs": [],
    "source": [
-    "def LPC_GS_pshift(x, f, G, P, overlap=0.2):\n",
+    "def LPC_GS_pshift(x, f, G, P, overlap=0.2, alpha=0.0):\n",
     "    N = len(x)\n",
-    "    y = np.zeros(N)\n",
+    "    y = np.zeros(N, dtype=np.result_type(x, np.float32))\n",
     "    igs = int(G * f + 0.5)\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    for n in range(0, len(x) - max(igs, G), stride):\n",
-    "        w = x[n:n+igs]\n",
-    "        a = lpc(w, P)\n",
-    "        e = sp.lfilter(a, [1], w)\n",
+    "    starts, A, E = lpc_analysis(x, igs, P, stride, max(igs, G), alpha)\n",
+    "    for n, a, e in zip(starts, A, E):\n",
     "        e = resample(e, f)\n",
-    "        w = sp.lfilter([1], a, e)\n",
+    "        w = lpc_synth(a, e)\n",
     "        y[n:n+G] += w * win\n",
     "    return y"
    ]
@@ -1107,16 +1600,17 @@
    },
    "outputs": [],
    "source": [
-    "def LPC_daft(x, f, Fs, G, P, th, overlap):\n",
+    "def LPC_daft(x, f, Fs, G, P, th, overlap, alpha=0.0):\n",
     "    d = (float(f) / Fs) * 2 * np.pi  \n",
-    "    e = np.sign(np.cos(d * np.arange(0, G)))\n",
+    "    dtype = np.result_type(x, np.float32)\n",
+    "    e = np.sign(np.cos(d * np.arange(0, G))).astype(dtype)\n",
     "    N = len(x)\n",
-    "    y = np.zeros(N)\n",
+    "    y = np.zeros(N, dtype=dtype)\n",
     "    win, stride = win_taper(G, overlap)\n",
-    "    for n in range(0, len(x) - G, stride):\n",
-    "        a = ld(bac(x[n:n+G], P), P)\n",
-    "        w = sp.lfilter([1], a, e)\n",
-    "        y[n:n+G] += w * win\n",
+    "    _, A, _ = lpc_analysis(x, G, P, stride, alpha=alpha)\n",
+    "    # the excitation is the same square wave for all segments\n",
+    "    W = _batch_lpc_synth(A, np.broadcast_to(e, (len(A), G)))\n",
+    "    _overlap_add(y, W, win, stride)\n",
     "    return y    "
    ]
   },
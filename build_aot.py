@@ -0,0 +1,128 @@
+"""Ahead-of-time compilation of the kernels used in 11_FIR-Filter-Implementation
+and in 17_Voice_Transformers.
+
+Numba compiles the kernels of the notebooks the first time they are called,
+which adds a noticeable delay to the first run of each session. Running
+
+    python build_aot.py
+
+once creates the `fir_kernels` and `lpc_kernels` extension modules next to
+this file; when a notebook finds its module, the double precision kernels are
+imported from there and no JIT compilation takes place. AOT compilation does
+not support parallel loops, so the batched LPC analysis is left to the JIT
+kernel of the notebook. The functions below must be kept in sync with the ones
+defined in the notebooks, compilation flags included; the exported functions
+themselves cannot take flags, so their loops live in njit helpers.
+"""
+import numpy as np
+from numba import njit
+from numba.pycc import CC
+
+cc = CC('fir_kernels')
+cc_lpc = CC('lpc_kernels')
+
+
+@njit(fastmath=True)
+def _fir_taps(h, buf, ix):
+    y = 0.0
+    for n in range(0, h.shape[0]):
+        y += h[n] * buf[ix+n]
+    return y
+
+
+@cc.export('fir_step', 'Tuple((f8, i8))(f8[::1], f8[::1], i8, f8)')
+def fir_step(h, buf, ix, x):
+    # mirrored power-of-two delay line, see _fir_step in the notebook; only used
+    # for filters shorter than 16 taps, so there is no BLAS branch
+    P = buf.shape[0] // 2
+    buf[ix] = x
+    buf[ix+P] = x
+    return _fir_taps(h, buf, ix), (ix - 1) & (P - 1)
+
+
+@njit(fastmath=True)
+def _fir_valid_acc(x, h, y):
+    M = h.shape[0]
+    K = y.shape[0]
+    n = 0
+    while n + 4 <= K:
+        s0 = s1 = s2 = s3 = 0.0
+        for k in range(0, M):
+            c = h[M-1-k]
+            s0 += c * x[n+k]
+            s1 += c * x[n+k+1]
+            s2 += c * x[n+k+2]
+            s3 += c * x[n+k+3]
+        y[n] += s0; y[n+1] += s1; y[n+2] += s2; y[n+3] += s3
+        n += 4
+    while n < K:
+        s = 0.0
+        for k in range(0, M):
+            s += h[M-1-k] * x[n+k]
+        y[n] += s
+        n += 1
+
+
+@cc.export('fir_valid_row', 'void(f8[::1], f8[::1], f8[::1])')
+def fir_valid_row(x, h, y):
+    y[:] = 0
+    _fir_valid_acc(x, h, y)
+
+
+@cc.export('fir_tiled', 'void(f8[::1], f8[::1], f8[::1], i8)')
+def fir_tiled(x, h, y, T):
+    M = h.shape[0]
+    K = y.shape[0]
+    y[:] = 0
+    for n0 in range(0, K, T):
+        n1 = min(n0 + T, K)
+        for k0 in range(0, M, T):
+            k1 = min(k0 + T, M)
+            _fir_valid_acc(x[n0+k0:n1+k1-1], h[M-k1:M-k0], y[n0:n1])
+
+
+@njit(fastmath=True)
+def _bac_direct(x, p):
+    # biased autocorrelation up to lag p, see _bac_direct in 17_Voice_Transformers
+    # (without pre-emphasis, i.e. alpha = 0)
+    L = x.shape[0]
+    r = np.zeros(p + 1)
+    for m in range(0, p + 1):
+        acc = 0.0
+        for n in range(0, L - m):
+            acc += x[n] * x[n + m]
+        r[m] = acc / L
+    return r
+
+
+@njit(fastmath={'contract'})
+def _ld(r, p):
+    # in-place Levinson-Durbin recursion, see _ld_nb in 17_Voice_Transformers
+    c = np.zeros(p)
+    c[0] = r[1] / r[0]
+    v = (1. - c[0] * c[0]) * r[0]
+    for i in range(1, p):
+        acc = 0.0
+        for k in range(0, i):
+            acc += c[k] * r[i-k]
+        g = (r[i+1] - acc) / v
+        for k in range(0, (i + 1) // 2):
+            lo, hi = c[k], c[i-1-k]
+            c[k] = lo - g * hi
+            c[i-1-k] = hi - g * lo
+        c[i] = g
+        v *= 1. - g * g
+    a = np.empty(p + 1)
+    a[0] = 1.
+    a[1:] = -c
+    return a
+
+
+@cc_lpc.export('lpc', 'f8[::1](f8[::1], i8)')
+def lpc(x, p):
+    return _ld(_bac_direct(x, p), p)
+
+
+if __name__ == '__main__':
+    cc.compile()
+    cc_lpc.compile()